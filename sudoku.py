@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 #
 # py-sudoku
@@ -20,110 +20,482 @@
 # limitations under the License.
 #
 
-from __future__ import division
-from __future__ import print_function
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from numba import njit
 import numpy as np
 
+#
+# Number of bits set for each 9-bit mask.
+#
+POPCOUNT = np.array([m.bit_count() for m in range(512)], dtype = np.uint8)
+
+#
+# Fields (row * 9 + column) of each row, column and 3x3 square.
+#
+UNITS = np.array(
+	[[row * 9 + column for column in range(9)] for row in range(9)] +
+	[[row * 9 + column for row in range(9)] for column in range(9)] +
+	[[((box // 3) * 3 + i // 3) * 9 + (box % 3) * 3 + i % 3 for i in range(9)] for box in range(9)],
+	dtype = np.int8
+)
+
+#
+# 3x3 square of each field (row * 9 + column).
+#
+BOX_OF = np.array([(row // 3) * 3 + (column // 3) for row in range(9) for column in range(9)], dtype = np.uint8)
+
+#
+# Row masks of a completed grid, packed into a single integer.
+#
+ALL_SET = sum(0x1FF << (9 * row) for row in range(9))
+
+#
+# Translation table mapping the numbers in a grid to their characters.
+#
+DIGITS = bytes.maketrans(bytes(range(10)), b"?123456789")
+
+#
+# Template for the string representation of a grid, with one placeholder
+# per field.
+#
+TEMPLATE = "\n---+---+---\n".join(["\n".join(["{}{}{}|{}{}{}|{}{}{}"] * 3)] * 3)
+
+#
+# Number of values tried on the calling thread before the search is split
+# across threads.
+#
+SERIAL_BUDGET = 10000
+
+#
+# Assign a number to an unsolved field and add it to the masks.
+#
+@njit(cache = True, boundscheck = False)
+def _place(g, rows, cols, boxes, field, value):
+	row, column = field // 9, field % 9
+	bit = 1 << (value - 1)
+	g[field] = value
+	rows[row] |= bit
+	cols[column] |= bit
+	boxes[BOX_OF[field]] |= bit
+
+#
+# Remove the number assigned to a field from the masks and mark the field
+# as unsolved.
+#
+@njit(cache = True, boundscheck = False)
+def _unplace(g, rows, cols, boxes, field):
+	row, column = field // 9, field % 9
+	bit = 1 << (g[field] - 1)
+	g[field] = 0
+	rows[row] ^= bit
+	cols[column] ^= bit
+	boxes[BOX_OF[field]] ^= bit
+
+#
+# Undo all assignments recorded on the trail above a mark.
+#
+# Returns the new top of the trail, i. e. the mark.
+#
+@njit(cache = True, boundscheck = False)
+def _undo(g, rows, cols, boxes, trail, mark, top):
+	
+	#
+	# Pop fields off the trail until the mark is reached.
+	#
+	while top > mark:
+		top -= 1
+		_unplace(g, rows, cols, boxes, trail[top])
+	
+	return top
+
+#
+# Assign all numbers that are implied by the Sudoku constraints, i. e.
+# fields with a single possible value (naked singles) and numbers with a
+# single possible field within a row, column or 3x3 square (hidden
+# singles), until no further assignment can be made.
+#
+# Every assigned field is pushed onto the trail.
+#
+# Returns whether the grid is still consistent, along with the new top of
+# the trail.
+#
+@njit(cache = True, boundscheck = False)
+def _propagate(g, rows, cols, boxes, trail, top):
+	changed = True
+	
+	#
+	# Repeat until a fixpoint is reached.
+	#
+	while changed:
+		changed = False
+		
+		#
+		# Find fields with a single possible value.
+		#
+		for field in range(81):
+			
+			if g[field] == 0:
+				row, column = field // 9, field % 9
+				box = BOX_OF[field]
+				m = ~(rows[row] | cols[column] | boxes[box]) & 0x1FF
+				
+				#
+				# If no value is allowed, the grid is inconsistent.
+				#
+				if m == 0:
+					return False, top
+				
+				if POPCOUNT[m] == 1:
+					_place(g, rows, cols, boxes, field, POPCOUNT[m - 1] + 1)
+					trail[top] = field
+					top += 1
+					changed = True
+		
+		#
+		# Find numbers with a single possible field in each unit.
+		#
+		for unit in range(27):
+			used = 0
+			once = 0
+			twice = 0
+			
+			#
+			# Accumulate the numbers allowed in at least one and in at least
+			# two fields of this unit.
+			#
+			for i in range(9):
+				field = UNITS[unit, i]
+				value = g[field]
+				
+				if value > 0:
+					bit = 1 << (value - 1)
+					
+					#
+					# If a number is present twice, the grid is inconsistent.
+					#
+					if used & bit:
+						return False, top
+					
+					used |= bit
+				else:
+					row, column = field // 9, field % 9
+					box = BOX_OF[field]
+					m = ~(rows[row] | cols[column] | boxes[box]) & 0x1FF
+					twice |= once & m
+					once |= m
+			
+			#
+			# If a number can neither be placed nor is present, the grid is
+			# inconsistent.
+			#
+			if (used | once) != 0x1FF:
+				return False, top
+			
+			hidden = once & ~twice
+			
+			#
+			# Assign each number that is allowed in only one field.
+			#
+			if hidden != 0:
+				
+				for i in range(9):
+					field = UNITS[unit, i]
+					
+					if g[field] == 0:
+						row, column = field // 9, field % 9
+						box = BOX_OF[field]
+						m = ~(rows[row] | cols[column] | boxes[box]) & hidden
+						
+						if m != 0:
+							m &= -m
+							_place(g, rows, cols, boxes, field, POPCOUNT[m - 1] + 1)
+							trail[top] = field
+							top += 1
+							changed = True
+	
+	return True, top
+
+#
+# Find the most constrained field of a grid, i. e. the one with the least
+# possible values, given the masks of numbers assigned within each row,
+# column and 3x3 square.
+#
+# Returns the field as (row * 9 + column) or -1 if all fields are solved.
+#
+@njit(cache = True, boundscheck = False)
+def _find_mrv(g, rows, cols, boxes):
+	lowest = 10
+	field = -1
+	
+	#
+	# Iterate over the fields.
+	#
+	for i in range(81):
+		
+		#
+		# If the current cell is not solved, find out how many combinations
+		# are allowed.
+		#
+		if g[i] == 0:
+			row, column = i // 9, i % 9
+			box = BOX_OF[i]
+			count = POPCOUNT[~(rows[row] | cols[column] | boxes[box]) & 0x1FF]
+			
+			#
+			# If there are less allowed than in other cells we've seen so far,
+			# make this our most constrained cell.
+			#
+			if count < lowest:
+				field = i
+				lowest = count
+	
+	return field
+
+#
+# Try to complete a grid by depth-first search, assigning the most
+# constrained field first and undoing the assignment on failure.
+#
+# The search keeps an explicit stack of the fields assigned on each level.
+# The number tried on a level is the one currently in the grid, so
+# backtracking only has to clear that field and try the next candidate.
+#
+# After each assignment, the constraints are propagated. The fields
+# assigned that way are kept on a trail, and each level marks where its
+# part of the trail begins, so it can be undone on backtracking.
+#
+# The search is abandoned as soon as cancel[0] is set, e. g. by another
+# thread which has found a solution, or once budget[0] values have been
+# tried. A negative budget does not limit the search.
+#
+# Returns True if a solution has been found, False otherwise. In the
+# latter case, the grid and the masks are left unmodified.
+#
+@njit(cache = True, boundscheck = False, nogil = True)
+def _solve(g, rows, cols, boxes, cancel, budget):
+	fields = np.empty(81, dtype = np.int8)
+	marks = np.empty(81, dtype = np.int8)
+	trail = np.empty(81, dtype = np.int8)
+	consistent, top = _propagate(g, rows, cols, boxes, trail, 0)
+	
+	#
+	# If the grid is inconsistent from the start, there is no solution.
+	#
+	if not consistent:
+		_undo(g, rows, cols, boxes, trail, 0, top)
+		return False
+	
+	field = _find_mrv(g, rows, cols, boxes)
+	
+	#
+	# If there is no unsolved field left, the Sudoku is completed.
+	#
+	if field < 0:
+		return True
+	
+	depth = 0
+	fields[0] = field
+	marks[0] = top
+	
+	#
+	# Continue as long as there are moves left on the stack.
+	#
+	while depth >= 0:
+		
+		#
+		# If the search has been cancelled or has run out of budget, unwind
+		# the stack.
+		#
+		if (cancel[0] != 0) or (budget[0] == 0):
+			
+			while depth >= 0:
+				top = _undo(g, rows, cols, boxes, trail, marks[depth], top)
+				
+				if g[fields[depth]] > 0:
+					_unplace(g, rows, cols, boxes, fields[depth])
+				
+				depth -= 1
+			
+			break
+		
+		top = _undo(g, rows, cols, boxes, trail, marks[depth], top)
+		field = fields[depth]
+		row, column = field // 9, field % 9
+		value = int(g[field])
+		
+		#
+		# Undo the number previously tried on this level.
+		#
+		if value > 0:
+			_unplace(g, rows, cols, boxes, field)
+		
+		m = ~(rows[row] | cols[column] | boxes[BOX_OF[field]]) & 0x1FF
+		value += 1
+		
+		#
+		# Find the next possible number for this field.
+		#
+		while (value <= 9) and ((m & (1 << (value - 1))) == 0):
+			value += 1
+		
+		#
+		# If all possibilities are exhausted, backtrack. Otherwise, try the
+		# number and descend if the grid is still consistent.
+		#
+		if value > 9:
+			depth -= 1
+		else:
+			budget[0] -= 1
+			_place(g, rows, cols, boxes, field, value)
+			consistent, top = _propagate(g, rows, cols, boxes, trail, top)
+			
+			if consistent:
+				field = _find_mrv(g, rows, cols, boxes)
+				
+				#
+				# If there is no unsolved field left, the Sudoku is completed.
+				#
+				if field < 0:
+					return True
+				
+				depth += 1
+				fields[depth] = field
+				marks[depth] = top
+	
+	_undo(g, rows, cols, boxes, trail, 0, top)
+	return False
+
 #
 # This class implements a Sudoku grid.
 #
 class Grid:
 	
 	#
-	# Initialize a 9x9 grid of numbers.
+	# Initialize a 9x9 grid of numbers, stored row by row as 81 bytes.
+	#
+	# Each row, column and 3x3 square also keeps a 9-bit mask of the numbers
+	# assigned within it, where bit (n - 1) is set if n is present. The row
+	# masks are additionally packed into a single 81-bit integer, with the
+	# mask of row r starting at bit (9 * r).
 	#
 	def __init__(self, grid = None):
-		self.__G = np.zeros((9, 9), dtype = np.int8)
+		self.__G = bytearray(81)
+		self.__rows = np.zeros(9, dtype = np.uint16)
+		self.__cols = np.zeros(9, dtype = np.uint16)
+		self.__boxes = np.zeros(9, dtype = np.uint16)
+		self.__state = 0
 	
 	#
 	# Set the number in a position, specified by row and column number, to
 	# a specific value.
 	#
 	def set_number(self, row, column, value):
-		self.__G[row, column] = value
+		row, column, value = int(row), int(column), int(value)
+		field = row * 9 + column
+		old = self.__G[field]
+		self.__G[field] = value
+		
+		#
+		# If a number is replaced, it may still be present elsewhere in its
+		# row, column or square, so rebuild the masks from the grid.
+		#
+		# Otherwise, add the new number to the masks.
+		#
+		if old > 0:
+			self.__update_masks()
+		elif value > 0:
+			bit = 1 << (value - 1)
+			self.__rows[row] |= bit
+			self.__cols[column] |= bit
+			self.__boxes[BOX_OF[field]] |= bit
+			self.__state |= bit << (9 * row)
 	
 	#
 	# Return the number assigned to a specific position, specified by row
 	# and column number.
 	#
 	def get_number(self, row, column):
-		return self.__G[row, column]
+		return self.__G[row * 9 + column]
 	
 	#
 	# Sets all entries in this grid to zero (unknown) state.
 	#
 	def clear(self):
+		self.__G[:] = bytes(81)
+		self.__rows.fill(0)
+		self.__cols.fill(0)
+		self.__boxes.fill(0)
+		self.__state = 0
+	
+	#
+	# Recompute the packed row masks.
+	#
+	def __update_state(self):
+		self.__state = sum(int(mask) << (9 * row) for row, mask in enumerate(self.__rows))
+	
+	#
+	# Recompute the row, column and square masks from the grid.
+	#
+	def __update_masks(self):
+		g = np.frombuffer(self.__G, dtype = np.uint8).reshape(9, 9)
 		
 		#
-		# Iterate over the rows.
+		# Map each number n to its bit (n - 1), and unknown fields to zero.
 		#
-		for row in range(9):
-			
-			#
-			# Iterate over the columns.
-			#
-			for column in range(9):
-				self.__G[row, column] = 0
+		bits = np.left_shift(1, g, dtype = np.uint16) >> 1
+		self.__rows[:] = np.bitwise_or.reduce(bits, axis = 1)
+		self.__cols[:] = np.bitwise_or.reduce(bits, axis = 0)
+		self.__boxes[:] = np.bitwise_or.reduce(bits.reshape(3, 3, 3, 3).swapaxes(1, 2).reshape(9, 9), axis = 1)
+		self.__update_state()
 	
 	#
 	# Set all values in the grid via a NumPy array.
 	#
+	# This rebuilds the masks and is not meant to be used by the solver.
+	#
 	def set_grid(self, grid):
 		
 		#
-		# Check if the grid is two-dimensional.
+		# Check if the grid is two-dimensional and 9x9.
 		#
-		if len(grid.shape) == 2:
-			
-			#
-			# Check if the grid is 9x9.
-			#
-			if (grid.shape[0] == 9) & (grid.shape[1] == 9):
-				self.__G[:, :] = np.copy(grid[:, :])
+		if grid.shape == (9, 9):
+			np.frombuffer(self.__G, dtype = np.uint8).reshape(9, 9)[...] = grid
+			self.__update_masks()
 	
 	#
 	# Return all values in the grid as a NumPy array.
 	#
+	# This returns a copy and is not meant to be used by the solver.
+	#
 	def get_grid(self):
-		return np.copy(self.__G[:, :])
+		return np.frombuffer(self.__G, dtype = np.uint8).reshape(9, 9).copy()
 	
 	#
 	# Check whether a specific position, specified by row and column
 	# number, has a number assigned.
 	#
 	def is_solved(self, row, column):
-		return self.__G[row, column] > 0
+		return self.__G[row * 9 + column] > 0
 	
 	#
-	# Check whether the Sudoku is completed, that is, every row and column
-	# has a number assigned.
+	# Check whether the Sudoku is completed, that is, every row has all
+	# numbers assigned.
 	#
 	def is_completed(self):
-		completed = True
-		
-		#
-		# Iterate over the rows.
-		#
-		for row in range(9):
-			
-			#
-			# Iterate over the columns.
-			#
-			for column in range(9):
-				
-				#
-				# If the current cell does not have a number assigned, the Sudoku is
-				# not solved.
-				#
-				if not self.is_solved(row, column):
-					completed = False
-		
-		return completed
+		return self.__state == ALL_SET
 	
 	#
-	# Return a list of all possible numbers for a given position,
-	# specified by row and column number.
+	# Return a bit mask of all possible numbers for a given position,
+	# specified by row and column number, where bit (n - 1) is set if n is
+	# allowed as per the Sudoku constraints.
+	#
+	def candidates_mask(self, row, column):
+		box = BOX_OF[row * 9 + column]
+		used = int(self.__rows[row]) | int(self.__cols[column]) | int(self.__boxes[box])
+		return ~used & 0x1FF
+	
+	#
+	# Yield all possible numbers for a given position, specified by row
+	# and column number.
 	#
 	def get_possibilities(self, row, column):
 		c = self.get_number(row, column)
@@ -132,24 +504,27 @@ class Grid:
 		# If the value of this cell is known, then this is the only possible
 		# value for the cell.
 		#
-		# Otherwise, generate a list of all possible values for this cell, as
-		# per the Sudoku constraints.
+		# Otherwise, yield all values allowed for this cell, as per the Sudoku
+		# constraints, by extracting the lowest set bit of the mask.
 		#
 		if c > 0:
-			return np.array([c])
+			yield c
 		else:
-			current_row = self.__G[row, :]
-			current_column = self.__G[:, column]
-			x, y = (row // 3) * 3, (column // 3) * 3
-			current_square = self.__G[x : x + 3, y : y + 3]
-			possible_numbers = [i for i in range(1, 10) if (i not in current_row) & (i not in current_column) & (i not in current_square)]
-			return possible_numbers
+			m = self.candidates_mask(row, column)
+			
+			while m:
+				yield (m & -m).bit_length()
+				m &= m - 1
 	
 	#
 	# Find the most constrained field, i. e. the one with the least
 	# possible values.
 	#
+	# Returns (-1, -1) if all fields are solved.
+	#
 	def find_most_constrained(self):
+		G = self.__G
+		candidates_mask = self.candidates_mask
 		lowest = 10
 		field = (-1, -1)
 		
@@ -167,9 +542,8 @@ class Grid:
 				# If the current cell is not solved, find out how many combinations
 				# are allowed.
 				#
-				if not self.is_solved(row, column):
-					possibilities = self.get_possibilities(row, column)
-					count = len(possibilities)
+				if G[row * 9 + column] == 0:
+					count = candidates_mask(row, column).bit_count()
 					
 					#
 					# If there are less allowed than in other cells we've seen so far,
@@ -182,73 +556,77 @@ class Grid:
 		return field
 	
 	#
-	# Solve the Sudoku iteratively.
+	# Solve the Sudoku using the compiled depth-first search.
+	#
+	# The search first runs on this thread with a limited budget. If that
+	# does not settle it, the constraints are propagated and the possible
+	# values of the most constrained field are searched in parallel, one
+	# thread each, on copies of the grid. The first thread to find a
+	# solution cancels the others.
+	#
+	# Returns True if a solution has been found, False otherwise. In the
+	# latter case, the grid is left unmodified.
 	#
 	def solve(self):
-		abort = False
-		queue = deque()
-		queue.append(self.get_grid())
-		completed = self.is_completed()
+		self.__update_masks()
+		g = np.frombuffer(self.__G, dtype = np.uint8)
+		cancel = np.zeros(1, dtype = np.uint8)
+		budget = np.array([SERIAL_BUDGET], dtype = np.int64)
+		
+		#
+		# Most puzzles are settled well within the budget.
+		#
+		if _solve(g, self.__rows, self.__cols, self.__boxes, cancel, budget):
+			self.__update_state()
+			return True
+		elif budget[0] != 0:
+			return False
 		
 		#
-		# As long as the Sudoku is not solved and there is no other reason to
-		# abort (e. g. queue empty), continue.
+		# Otherwise, split the search at the most constrained field left
+		# after propagating the constraints on a copy of the grid.
+		#
+		root = (g.copy(), self.__rows.copy(), self.__cols.copy(), self.__boxes.copy())
+		_propagate(*root, np.empty(81, dtype = np.int8), 0)
+		field = _find_mrv(*root)
+		_, root_rows, root_cols, root_boxes = root
+		m = ~(int(root_rows[field // 9]) | int(root_cols[field % 9]) | int(root_boxes[BOX_OF[field]])) & 0x1FF
+		possibilities = [value for value in range(1, 10) if m & (1 << (value - 1))]
+		searches = {}
+		
 		#
-		while (not completed) & (not abort):
-			row, column = self.find_most_constrained()
-			possibilities = self.get_possibilities(row, column)
+		# Search each possibility on its own copy of the grid and masks.
+		#
+		with ThreadPoolExecutor(max_workers = len(possibilities)) as executor:
 			
-			#
-			# Try all possibilities.
-			#
 			for possibility in possibilities:
-				self.set_number(row, column, possibility)
-				queue.append(self.get_grid())
-			
-			self.set_grid(queue.popleft())
-			completed = self.is_completed()
+				state = tuple(a.copy() for a in root)
+				_place(*state, field, possibility)
+				unlimited = np.array([-1], dtype = np.int64)
+				searches[executor.submit(_solve, *state, cancel, unlimited)] = state
 			
 			#
-			# Abort if the queue is empty.
+			# Take the first solution found and cancel the other searches.
 			#
-			if len(queue) == 0:
-				abort = True
+			for future in as_completed(searches):
+				
+				if future.result():
+					cancel[0] = 1
+					solution, rows, cols, boxes = searches[future]
+					g[:] = solution
+					self.__rows[:] = rows
+					self.__cols[:] = cols
+					self.__boxes[:] = boxes
+					self.__update_state()
+					return True
+		
+		return False
 	
 	#
 	# Creates a string representation of this Sudoku grid.
 	#
 	def to_string(self):
-		rows = []
-		
-		#
-		# Iterate over the rows.
-		#
-		for row in range(9):
-			the_row = []
-			
-			#
-			# Insert line separator every three lines.
-			#
-			if (row % 3 == 0) & (row > 0):
-				rows.append("---+---+---")
-			
-			#
-			# Iterate over the columns.
-			#
-			for column in range(9):
-				
-				#
-				# Insert column separator every three columns.
-				#
-				if (column % 3 == 0) & (column > 0):
-					the_row.append("|")
-				
-				n = self.get_number(row, column)
-				the_row.append(str(n) if n > 0 else "?")
-			
-			rows.append("".join(the_row))
-		
-		return "\n".join(rows)
+		return TEMPLATE.format(*self.__G.translate(DIGITS).decode())
 	
 	#
 	# Override the str() cast operation.
@@ -281,7 +659,7 @@ if __name__ == "__main__":
 	#
 	while not stop:
 		print("> ", end = "")
-		user_input = raw_input()
+		user_input = input()
 		split_input = str.split(user_input)
 		
 		#
@@ -313,7 +691,7 @@ if __name__ == "__main__":
 						#
 						# Check if values are in the correct range.
 						#
-						if (row >= 1) & (row <= 9) & (column >= 1) & (column <= 9) & (value >= 1) & (value <= 9):
+						if (1 <= row <= 9) and (1 <= column <= 9) and (1 <= value <= 9):
 							grid.set_number(row - 1, column - 1, value)
 							print()
 							print(str(grid))
@@ -343,7 +721,7 @@ if __name__ == "__main__":
 						#
 						# Check if values are in the correct range.
 						#
-						if (row >= 1) & (row <= 9) & (column >= 1) & (column <= 9):
+						if (1 <= row <= 9) and (1 <= column <= 9):
 							grid.set_number(row - 1, column - 1, 0)
 							print()
 							print(str(grid))